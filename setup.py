@@ -37,6 +37,8 @@ CLASSIFIERS = ['Intended Audience :: Science/Research',
                'Programming Language :: Python :: 3.6',
                'Programming Language :: Python :: 3.7']
 EXTRAS_REQUIRE = {
+    'numba': [
+        'numba'],
     'tests': [
         'pytest',
         'pytest-cov'],
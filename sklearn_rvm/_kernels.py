@@ -0,0 +1,64 @@
+"""Compiled kernel functions.
+
+These are only used when numba is installed; otherwise the kernels are
+evaluated with :func:`sklearn.metrics.pairwise.pairwise_kernels`.
+"""
+# Author: Pedro Ferreira da Costa
+#         Walter Hugo Lopez Pinaya
+# License: BSD 3 clause
+import math
+
+import numpy as np
+from sklearn.metrics.pairwise import check_pairwise_arrays
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _rbf_kernel_fill(X, Y, gamma, out):
+        """Fill out[i, j] with exp(-gamma * ||X[i] - Y[j]||^2)."""
+        for i in numba.prange(X.shape[0]):
+            for j in range(Y.shape[0]):
+                acc = 0.0
+                for k in range(X.shape[1]):
+                    diff = X[i, k] - Y[j, k]
+                    acc += diff * diff
+                out[i, j] = math.exp(-gamma * acc)
+
+
+def rbf_kernel(X, Y=None, gamma=None):
+    """Compute the rbf (gaussian) kernel between X and Y.
+
+    Equivalent to :func:`sklearn.metrics.pairwise.rbf_kernel`, but the
+    squared distances are accumulated and exponentiated in a single pass
+    without materialising the distance matrix.
+
+    Parameters
+    ----------
+    X : array-like, shape (n_samples_X, n_features)
+
+    Y : array-like, shape (n_samples_Y, n_features) or None
+        If None, uses Y=X.
+
+    gamma : float or None, optional (default=None)
+        If None, defaults to 1.0 / n_features.
+
+    Returns
+    -------
+    kernel_matrix : array, shape (n_samples_X, n_samples_Y)
+        Single precision if both X and Y are float32, double otherwise.
+    """
+    X, Y = check_pairwise_arrays(X, Y)
+    X = np.ascontiguousarray(X)
+    Y = np.ascontiguousarray(Y)
+
+    if gamma is None:
+        gamma = 1.0 / X.shape[1]
+
+    K = np.empty((X.shape[0], Y.shape[0]), dtype=X.dtype)
+    _rbf_kernel_fill(X, Y, float(gamma), K)
+    return K
@@ -10,11 +10,13 @@ Based on
 #         Walter Hugo Lopez Pinaya
 # License: BSD 3 clause
 import warnings
+import zlib
 from abc import ABCMeta, abstractmethod
 
 import numpy as np
 import scipy.linalg
 from numpy import linalg
+from scipy.linalg.blas import get_blas_funcs
 from scipy.optimize import minimize
 from scipy.special import expit
 from sklearn.base import RegressorMixin, BaseEstimator, ClassifierMixin
@@ -22,6 +24,8 @@ from sklearn.metrics.pairwise import pairwise_kernels
 from sklearn.multiclass import OneVsRestClassifier
 from sklearn.utils.validation import check_X_y, check_is_fitted, check_array
 
+from . import _fit_numba, _kernels
+
 
 class BaseRVM(BaseEstimator, metaclass=ABCMeta):
     """Basic class for Relevance Vector Machine."""
@@ -56,6 +60,8 @@ class BaseRVM(BaseEstimator, metaclass=ABCMeta):
         if callable(self.kernel):
             params = self.kernel_params or {}
         else:
+            if self.kernel == "rbf" and _kernels.numba is not None:
+                return _kernels.rbf_kernel(X, Y, gamma=self._gamma)
             params = {"gamma": self._gamma,
                       "degree": self.degree,
                       "coef0": self.coef0}
@@ -69,6 +75,10 @@ class BaseRVM(BaseEstimator, metaclass=ABCMeta):
         if not np.any(keep_alpha):
             keep_alpha[0] = True
 
+        # Nothing to remove, skip copying every fitted array
+        if np.all(keep_alpha):
+            return keep_alpha
+
         if self.bias_used:
             if not keep_alpha[0]:
                 self.bias_used = False
@@ -85,9 +95,12 @@ class BaseRVM(BaseEstimator, metaclass=ABCMeta):
         self._alpha_old = self._alpha_old[keep_alpha]
         self.gamma_ = self.gamma_[keep_alpha]
         self.Phi_ = self.Phi_[:, keep_alpha]
-        self.Sigma_ = self.Sigma_[np.ix_(keep_alpha, keep_alpha)]
+        if self.Sigma_ is not None:
+            self.Sigma_ = self.Sigma_[np.ix_(keep_alpha, keep_alpha)]
         self.mu_ = self.mu_[keep_alpha]
 
+        return keep_alpha
+
     @property
     def _pairwise(self):
         return self.kernel == "precomputed"
@@ -165,6 +178,12 @@ class EMRVR(RegressorMixin, BaseRVM):
     verbose : boolean, optional (default=False)
         Enable verbose output.
 
+    dtype : {"float64", "float32"}, optional (default="float64")
+        Precision used to evaluate and store the kernel matrix. With
+        "float32" it takes half the memory, while its products and the
+        posterior and hyperparameter updates are still computed in double
+        precision.
+
     Attributes
     ----------
     relevance_ : array-like, shape (n_relevance)
@@ -210,7 +229,9 @@ class EMRVR(RegressorMixin, BaseRVM):
                  coef0=0.0, tol=1e-3, threshold_alpha=1e9,
                  beta_fixed="not_fixed", alpha_max=1e10, init_alpha=None,
                  bias_used=True, max_iter=5000, compute_score=False,
-                 epsilon=1e-08, verbose=False):
+                 epsilon=1e-08, verbose=False, dtype="float64"):
+
+        self.dtype = dtype
 
         super().__init__(
             kernel=kernel, degree=degree, gamma=gamma, coef0=coef0, tol=tol,
@@ -245,10 +266,17 @@ class EMRVR(RegressorMixin, BaseRVM):
         """
         X, y = check_X_y(X, y, y_numeric=True, ensure_min_samples=2,
                          dtype="float64")
+        # check_X_y only converts X, the targets are kept as given
+        y = y.astype(np.float64, copy=False)
 
         if self.kernel == "precomputed" and X.shape[0] != X.shape[1]:
             raise ValueError("X.shape[0] should be equal to X.shape[1]")
 
+        # Cheap fingerprint of the training data, checked by predict when
+        # X_is_train is set
+        self._X_fit_fingerprint = (X.shape,
+                                   zlib.crc32(np.ascontiguousarray(X)))
+
         if self.gamma in ("scale", "auto_deprecated"):
             X_var = X.var()
             if self.gamma == "scale":
@@ -275,10 +303,17 @@ class EMRVR(RegressorMixin, BaseRVM):
         else:
             self._gamma = self.gamma
 
+        # Checked before the conversion, np.dtype raises TypeError for
+        # strings it cannot parse
+        if self.dtype not in ("float32", "float64", np.float32, np.float64):
+            raise ValueError("dtype must be 'float32' or 'float64', "
+                             "got {!r}".format(self.dtype))
+        dtype = np.dtype(self.dtype)
+
         self.scores_ = list()
 
         n_samples = X.shape[0]
-        self.Phi_ = self._get_kernel(X)
+        self.Phi_ = self._get_kernel(X.astype(dtype, copy=False))
 
         # Scale Phi based on PRoNTO implementation
         # http://www.mlnl.cs.ucl.ac.uk/pronto/
@@ -286,14 +321,19 @@ class EMRVR(RegressorMixin, BaseRVM):
         self.Phi_ = self.Phi_ / self._scale
 
         if self.bias_used:
-            self.Phi_ = np.hstack((np.ones((n_samples, 1)), self.Phi_))
+            self.Phi_ = np.hstack((np.ones((n_samples, 1), dtype=dtype),
+                                   self.Phi_))
 
         M = self.Phi_.shape[1]
 
-        if self.init_alpha == None:
-            self.init_alpha = 1 / M ** 2
+        # Resolve the default locally so that refitting on data of another
+        # size does not reuse the value derived for the previous fit
+        if self.init_alpha is None:
+            init_alpha = 1 / M ** 2
+        else:
+            init_alpha = self.init_alpha
 
-        self.relevance_ = np.array(range(n_samples))
+        self.relevance_ = np.arange(n_samples)
         if self.kernel != "precomputed":
             self.relevance_vectors_ = X
         else:
@@ -306,48 +346,97 @@ class EMRVR(RegressorMixin, BaseRVM):
         else:
             self.beta_ = self.beta_fixed
 
-        self.alpha_ = self.init_alpha * np.ones(M)
-
-        self._alpha_old = self.alpha_.copy()
-
-        for i in range(self.max_iter):
-            A = np.diag(self.alpha_)
-            hessian = self.beta_ * self.Phi_.T @ self.Phi_ + A
+        self.alpha_ = np.full(M, init_alpha, dtype=np.float64)
+
+        self._alpha_old = self.alpha_
+
+        # Phi_ only loses columns during training, so these products are
+        # computed once and pruned alongside it
+        # syrk only computes the upper triangle of the symmetric product;
+        # passing Phi_.T lets BLAS read the C-ordered Phi_ without a copy.
+        # The products are accumulated in double precision: rounding them to
+        # single precision breaks the positive definiteness of the Hessian
+        # for smooth kernels. A single precision Phi_ is upcast one block of
+        # rows at a time so that it is never held in double precision
+        syrk = get_blas_funcs("syrk", dtype=np.float64)
+        if dtype == np.float64:
+            n_block = n_samples
+        else:
+            n_block = 4096
+        PhiTPhi = np.zeros((M, M), order="F")
+        PhiTy = np.zeros(M)
+        for start in range(0, n_samples, n_block):
+            block = self.Phi_[start:start + n_block].astype(np.float64,
+                                                           copy=False)
+            PhiTPhi = syrk(1.0, block.T, beta=1.0, c=PhiTPhi, trans=0,
+                           lower=0, overwrite_c=True)
+            PhiTy += block.T @ y[start:start + n_block]
+        PhiTPhi = np.triu(PhiTPhi) + np.triu(PhiTPhi, 1).T
+
+        start = 0
+        compiled = self._fit_compiled(X, y, PhiTPhi, PhiTy)
+        if compiled is not None:
+            success, start, active = compiled
+            if success:
+                return self
+            # The Hessian stopped being positive definite, carry on from
+            # the same iteration and basis functions in the Python loop
+            PhiTPhi = PhiTPhi[np.ix_(active, active)]
+            PhiTy = PhiTy[active]
+
+        # Workspace reused across iterations and only reallocated when
+        # pruning shrinks it. The Hessian is kept in Fortran order so that
+        # LAPACK can factor it in place
+        hessian = np.empty(PhiTPhi.shape, order="F")
+        identity = np.eye(PhiTPhi.shape[0])
+        lower_inv = None
+
+        for i in range(start, self.max_iter):
+            np.multiply(self.beta_, PhiTPhi, out=hessian)
+            hessian.flat[::hessian.shape[0] + 1] += self.alpha_
 
             # Calculate Sigma and mu
             # Use Cholesky decomposition for efficiency
             # Ref: https://arxiv.org/abs/1111.4144
             chol_fail = False
             try:
-                upper = scipy.linalg.cholesky(hessian)
+                lower, low = scipy.linalg.cho_factor(hessian, lower=True,
+                                                     overwrite_a=True,
+                                                     check_finite=False)
             except linalg.LinAlgError:
                 warnings.warn("Hessian not positive definite")
                 chol_fail = True
 
             if chol_fail:
+                # The failed factorization has overwritten the buffer
+                np.multiply(self.beta_, PhiTPhi, out=hessian)
+                hessian.flat[::hessian.shape[0] + 1] += self.alpha_
                 try:
-                    self.Sigma_ = np.linalg.inv(hessian)
+                    # Symmetric indefinite (LDL^T) solve rather than LU
+                    self.Sigma_ = scipy.linalg.solve(
+                        hessian, identity, assume_a="sym", check_finite=False)
                 except linalg.LinAlgError:
                     warnings.warn("Using Pseudo-Inverse")
                     self.Sigma_ = np.linalg.pinv(hessian)
 
-                self.mu_ = self.beta_ * (self.Sigma_ @ self.Phi_.T @ y)
+                self.mu_ = self.beta_ * (self.Sigma_ @ PhiTy)
                 sigma_diag = np.diag(self.Sigma_)
+                lower_inv = None
 
             else:
-                try:
-                    upper_inv = np.linalg.inv(upper)
-                except linalg.LinAlgError:
-                    warnings.warn("Using Pseudo-Inverse")
-                    upper_inv = np.linalg.pinv(upper)
-
-                self.Sigma_ = np.dot(upper_inv, upper_inv.conj().T)
-
-                self.mu_ = (upper_inv @ (
-                        upper_inv.conj().T @ self.Phi_.T @ y)) * self.beta_
+                if hessian.shape[0] == 1:
+                    # A single basis function is left, the factor is scalar
+                    lower_inv = 1 / lower
+                else:
+                    lower_inv = scipy.linalg.solve_triangular(
+                        lower, identity, lower=True, check_finite=False)
 
-                # Equivalent sigma_diag = np.diag(self.Sigma_)
-                sigma_diag = np.sum(upper_inv ** 2, axis=1)
+                # Sigma_ = lower_inv.T @ lower_inv, but only its diagonal is
+                # needed while iterating so it is formed after the loop
+                self.Sigma_ = None
+                self.mu_ = self.beta_ * scipy.linalg.cho_solve(
+                    (lower, low), PhiTy, check_finite=False)
+                sigma_diag = np.einsum("ji,ji->i", lower_inv, lower_inv)
 
             # Well-determinedness parameters (gamma)
             self.gamma_ = 1 - self.alpha_ * sigma_diag
@@ -358,7 +447,9 @@ class EMRVR(RegressorMixin, BaseRVM):
                     self.mu_ ** 2) + self.epsilon
 
             if self.beta_fixed == "not_fixed":
-                # Prediction error
+                # Prediction error. Evaluated directly: expanding it in terms
+                # of PhiTPhi and PhiTy cancels catastrophically on fits with
+                # little noise
                 ed = np.sum((y - self.Phi_ @ self.mu_) ** 2)
                 self.beta_ = max((n_samples - np.sum(self.gamma_)),
                                  self.epsilon) / ed + self.epsilon
@@ -366,7 +457,8 @@ class EMRVR(RegressorMixin, BaseRVM):
             # Compute marginal likelihood
             if not chol_fail:
                 if self.compute_score:
-                    ll = self.compute_marginal_likelihood(upper_inv, ed,
+                    # The inverse of the upper factor is lower_inv.T
+                    ll = self.compute_marginal_likelihood(lower_inv.T, ed,
                                                           n_samples, y)
                     self.scores_.append(ll)
 
@@ -383,18 +475,75 @@ class EMRVR(RegressorMixin, BaseRVM):
                 print()
 
             # Prune based on large values of alpha
-            self._prune()
+            keep_alpha = self._prune()
+            if not np.all(keep_alpha):
+                PhiTPhi = PhiTPhi[np.ix_(keep_alpha, keep_alpha)]
+                PhiTy = PhiTy[keep_alpha]
+                hessian = np.empty(PhiTPhi.shape, order="F")
+                identity = np.eye(PhiTPhi.shape[0])
+                if lower_inv is not None:
+                    lower_inv = lower_inv[:, keep_alpha]
 
             # Terminate if the largest alpha change is smaller than threshold
-            delta = np.amax(
-                np.absolute(np.log(self.alpha_ + self.epsilon) - np.log(
-                    self._alpha_old + self.epsilon)))
+            delta = np.amax(np.absolute(np.log(
+                (self.alpha_ + self.epsilon) /
+                (self._alpha_old + self.epsilon))))
             if delta < self.tol and i > 1:
                 break
 
-            self._alpha_old = self.alpha_.copy()
+            # alpha_ is rebound to a new array by every update above and
+            # never modified in place, so keeping a reference is enough
+            self._alpha_old = self.alpha_
+
+        if lower_inv is not None:
+            self.Sigma_ = lower_inv.T @ lower_inv
+
+        return self
+
+    def _fit_compiled(self, X, y, PhiTPhi, PhiTy):
+        """Run the training loop compiled with numba.
 
-    def predict(self, X, return_std=False):
+        Returns None without modifying the model if numba is not installed,
+        if per-iteration output is requested, or if there are more basis
+        functions than the compiled loop handles efficiently. Otherwise
+        returns ``(success, n_iter, active)``, where ``active`` indexes the
+        remaining columns of PhiTPhi. When the Hessian stops being positive
+        definite, success is False and the model holds the state of
+        iteration ``n_iter``, so that the Python loop and its
+        inverse/pseudo-inverse handling can resume from there.
+        """
+        if _fit_numba.fit_loop is None or self.compute_score or self.verbose:
+            return None
+        if self.Phi_.shape[1] > _fit_numba.MAX_BASIS_FUNCTIONS:
+            return None
+
+        (success, n_iter, active, alpha, alpha_old, gamma, Sigma, mu,
+         beta) = _fit_numba.fit_loop(
+            self.Phi_, y, np.ascontiguousarray(PhiTPhi),
+            np.ascontiguousarray(PhiTy), self.alpha_, float(self.beta_),
+            self.beta_fixed == "not_fixed", self.max_iter, float(self.tol),
+            float(self.threshold_alpha), float(self.epsilon))
+
+        # Map the surviving basis functions back to samples, as _prune does
+        if self.bias_used:
+            self.bias_used = bool(active[0] == 0)
+            self.relevance_ = active[active > 0] - 1
+        else:
+            self.relevance_ = active
+        if self.kernel != "precomputed":
+            self.relevance_vectors_ = X[self.relevance_]
+
+        self.Phi_ = self.Phi_[:, active]
+        self.alpha_ = alpha
+        self._alpha_old = alpha_old
+        self.beta_ = beta
+        if success:
+            self.gamma_ = gamma
+            self.Sigma_ = Sigma
+            self.mu_ = mu
+        return success, n_iter, active
+
+    def predict(self, X, return_std=False, X_is_train=False):
         """Predict using the RVR model.
 
         In addition to the mean of the predictive distribution, its
@@ -409,6 +558,13 @@ class EMRVR(RegressorMixin, BaseRVM):
             If True, the standard-deviation of the predictive distribution at
             the query points is returned along with the mean.
 
+        X_is_train : bool, optional (default=False)
+            If True, X must be the data the model was fitted on. The kernel
+            between the training samples and the relevance vectors is then
+            taken from ``Phi_`` instead of being evaluated again. X is
+            compared with the training data through its shape and a
+            checksum, and a ValueError is raised if they differ.
+
         Returns
         -------
         y_mean : array, shape (n_samples, n_output_dims)
@@ -423,21 +579,33 @@ class EMRVR(RegressorMixin, BaseRVM):
         X = check_array(X)
 
         n_samples = X.shape[0]
-        if self.kernel != "precomputed":
-            K = self._get_kernel(X, self.relevance_vectors_)
+        if X_is_train:
+            # Phi_ already holds the scaled training kernel restricted to
+            # the relevance vectors, including the bias column
+            fingerprint = (X.shape, zlib.crc32(
+                np.ascontiguousarray(X, dtype=np.float64)))
+            if fingerprint != self._X_fit_fingerprint:
+                raise ValueError("X_is_train is set but X is not the data "
+                                 "the model was fitted on")
+            K = self.Phi_
         else:
-            K = X[:, self.relevance_]
-        K = K / self._scale
+            if self.kernel != "precomputed":
+                K = self._get_kernel(X, self.relevance_vectors_)
+            else:
+                K = X[:, self.relevance_]
+            K = K / self._scale
 
-        if self.bias_used:
-            K = np.hstack((np.ones((n_samples, 1)), K))
+            if self.bias_used:
+                K = np.hstack((np.ones((n_samples, 1)), K))
 
         y_mean = K @ self.mu_
         if return_std is False:
             return y_mean
         else:
-            err_var = (1 / self.beta_) + K @ self.Sigma_ @ K.T
-            y_std = np.sqrt(np.diag(err_var))
+            # Only the diagonal of K @ Sigma_ @ K.T is needed
+            err_var = (1 / self.beta_) + np.einsum("ij,ij->i",
+                                                   K @ self.Sigma_, K)
+            y_std = np.sqrt(err_var)
             return y_mean, y_std
 
 
@@ -575,21 +743,25 @@ class EMRVC(BaseRVM, ClassifierMixin):
 
     def _log_posterior(self, mu, alpha, Phi_, t):
         """ Calculate log posterior."""
-        y = self._classify(mu, Phi_)
+        a = np.dot(Phi_, mu)
+        y = expit(a)
 
-        log_p = -1 * (np.sum(np.log(y[t == 1]), 0) +
-                      np.sum(np.log(1 - y[t == 0]), 0))
-        log_p = log_p + 0.5 * np.dot(mu.T, np.dot(np.diag(alpha), mu))
+        # Negative Bernoulli log-likelihood over all samples at once,
+        # -sum(t * log(y) + (1 - t) * log(1 - y)) written in terms of a
+        log_p = np.sum(np.logaddexp(0, a) - t * a)
+        log_p = log_p + 0.5 * np.dot(mu, alpha * mu)
 
-        jacobian = np.dot(np.diag(alpha), mu) - np.dot(Phi_.T, (t - y))
+        jacobian = alpha * mu - np.dot(Phi_.T, (t - y))
 
         return log_p, jacobian
 
     def _compute_hessian(self, mu, alpha, Phi_, t):
         """ Perform the Inverse of Covariance."""
         y = self._classify(mu, Phi_)
-        B = np.diag(y * (1 - y))
-        return np.diag(alpha) + np.dot(Phi_.T, np.dot(B, Phi_))
+        # Phi_.T @ diag(y * (1 - y)) @ Phi_ without forming the diagonal
+        hessian = np.dot(Phi_.T * (y * (1 - y)), Phi_)
+        hessian.flat[::hessian.shape[0] + 1] += alpha
+        return hessian
 
     def _posterior(self):
         """ Calculate the posterior likelihood."""
@@ -615,26 +787,24 @@ class EMRVC(BaseRVM, ClassifierMixin):
         # Ref: https://arxiv.org/abs/1111.4144
         chol_fail = False
         try:
-            upper = scipy.linalg.cholesky(hessian)
+            factor = scipy.linalg.cho_factor(hessian, lower=True,
+                                             check_finite=False)
         except linalg.LinAlgError:
             warnings.warn("Hessian not positive definite")
             chol_fail = True
 
         if chol_fail:
             try:
-                self.Sigma_ = np.linalg.inv(hessian)
+                self.Sigma_ = scipy.linalg.solve(
+                    hessian, np.eye(hessian.shape[0]), assume_a="sym",
+                    check_finite=False)
             except linalg.LinAlgError:
                 warnings.warn("Using Pseudo-Inverse")
                 self.Sigma_ = np.linalg.pinv(hessian)
 
         else:
-            try:
-                upper_inv = np.linalg.inv(upper)
-            except linalg.LinAlgError:
-                warnings.warn("Using Pseudo-Inverse")
-                upper_inv = np.linalg.pinv(upper)
-
-            self.Sigma_ = np.dot(upper_inv, upper_inv.conj().T)
+            self.Sigma_ = scipy.linalg.cho_solve(
+                factor, np.eye(hessian.shape[0]), check_finite=False)
 
     def fit(self, X, y):
         """Fit the RVC model according to the given training data.
@@ -712,10 +882,12 @@ class EMRVC(BaseRVM, ClassifierMixin):
 
             self.y = y
 
-            if self.init_alpha == None:
-                self.init_alpha = 1 / M ** 2
+            if self.init_alpha is None:
+                init_alpha = 1 / M ** 2
+            else:
+                init_alpha = self.init_alpha
 
-            self.relevance_ = np.array(range(n_samples))
+            self.relevance_ = np.arange(n_samples)
             if self.kernel != "precomputed":
                 self.relevance_vectors_ = X
             else:
@@ -729,9 +901,9 @@ class EMRVC(BaseRVM, ClassifierMixin):
 
             self.mu_ = np.zeros(M)
 
-            self.alpha_ = self.init_alpha * np.ones(M)
+            self.alpha_ = np.full(M, init_alpha, dtype=np.float64)
 
-            self._alpha_old = self.alpha_.copy()
+            self._alpha_old = self.alpha_
 
             for i in range(self.max_iter):
                 self._posterior()
@@ -764,14 +936,14 @@ class EMRVC(BaseRVM, ClassifierMixin):
                         pass
                     print()
 
-                delta = np.amax(
-                    np.absolute(np.log(self.alpha_ + self.epsilon) - np.log(
-                        self._alpha_old + self.epsilon)))
+                delta = np.amax(np.absolute(np.log(
+                    (self.alpha_ + self.epsilon) /
+                    (self._alpha_old + self.epsilon))))
 
                 if delta < self.tol and i > 1:
                     break
 
-                self._alpha_old = self.alpha_.copy()
+                self._alpha_old = self.alpha_
 
             return self
 
@@ -0,0 +1,16 @@
+import pytest
+import numpy as np
+from sklearn.metrics.pairwise import rbf_kernel
+
+pytest.importorskip("numba")
+from sklearn_rvm import _kernels
+
+rng = np.random.RandomState(0)
+
+
+def test_rbf_kernel_matches_sklearn():
+    X = rng.rand(30, 4)
+    Y = rng.rand(10, 4)
+    np.testing.assert_allclose(_kernels.rbf_kernel(X, Y, gamma=0.5),
+                               rbf_kernel(X, Y, gamma=0.5))
+    np.testing.assert_allclose(_kernels.rbf_kernel(X), rbf_kernel(X))
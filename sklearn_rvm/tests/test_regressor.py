@@ -1,14 +1,40 @@
+import warnings
+
 import pytest
 import numpy as np
 from sklearn_rvm import EMRVR
 from sklearn.metrics.pairwise import pairwise_kernels
 from sklearn import datasets
 
-boston = datasets.load_boston()
+diabetes = datasets.load_diabetes()
 rng = np.random.RandomState(0)
-perm = rng.permutation(boston.target.size)
-boston.data = boston.data[perm]
-boston.target = boston.target[perm]
+perm = rng.permutation(diabetes.target.size)
+diabetes.data = diabetes.data[perm]
+diabetes.target = diabetes.target[perm]
+
+
+def _sinc_data(noise=0.05, n_samples=100):
+    # Own seed, so that the data do not depend on which tests ran before
+    X = np.linspace(-5, 5, n_samples).reshape(-1, 1)
+    y = np.sinc(X).ravel()
+    y += noise * np.random.RandomState(0).randn(n_samples)
+    return X, y
+
+
+def _record_fit_loop(monkeypatch):
+    # Wrap the compiled loop so that tests can check what it returned
+    from sklearn_rvm import _fit_numba
+    fit_loop = _fit_numba.fit_loop
+    results = []
+
+    def recording_fit_loop(*args):
+        result = fit_loop(*args)
+        results.append(result)
+        return result
+
+    monkeypatch.setattr(_fit_numba, "fit_loop", recording_fit_loop)
+    return results
+
 
 def test_simple_fit_predict():
     X = np.array([[0, 0], [2, 2]])
@@ -20,8 +46,182 @@ def test_simple_fit_predict():
     assert pred != None
 
 def test_precomputed_fit_predict():
-    kernel = pairwise_kernels(boston.data, metric='linear')
+    kernel = pairwise_kernels(diabetes.data, metric='linear')
     clf = EMRVR(kernel = "precomputed")
-    clf.fit(kernel, boston.target)
+    clf.fit(kernel, diabetes.target)
     pred = clf.predict(kernel)
-    assert pred.shape == boston.target.shape
+    assert pred.shape == diabetes.target.shape
+
+@pytest.mark.parametrize("y_dtype", [np.float64, np.float32])
+def test_float32_fit_predict(y_dtype):
+    X, y = _sinc_data()
+    y = y.astype(y_dtype)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        clf = EMRVR(gamma=1.0, dtype="float32")
+        clf.fit(X, y)
+    clf64 = EMRVR(gamma=1.0)
+    clf64.fit(X, y)
+
+    assert clf.Phi_.dtype == np.float32
+    np.testing.assert_array_equal(clf.relevance_, clf64.relevance_)
+    np.testing.assert_allclose(clf.beta_, clf64.beta_, rtol=1e-4)
+    pred = clf.predict(X)
+    assert pred.dtype == np.float64
+    np.testing.assert_allclose(pred, clf64.predict(X), rtol=1e-4, atol=1e-5)
+
+    for dtype in ("int32", "foo"):
+        with pytest.raises(ValueError):
+            EMRVR(dtype=dtype).fit(X, y)
+
+
+@pytest.mark.parametrize("noise", [0.05, 1e-6])
+def test_compiled_fit_matches_python(monkeypatch, noise):
+    pytest.importorskip("numba")
+    from sklearn_rvm import _fit_numba
+
+    X, y = _sinc_data(noise)
+
+    results = _record_fit_loop(monkeypatch)
+    compiled = EMRVR(gamma=1.0)
+    compiled.fit(X, y)
+    assert [result[0] for result in results] == [True]
+
+    monkeypatch.setattr(_fit_numba, "fit_loop", None)
+    python = EMRVR(gamma=1.0)
+    python.fit(X, y)
+
+    _assert_beta_matches_direct_residual(compiled, y)
+    _assert_beta_matches_direct_residual(python, y)
+    np.testing.assert_array_equal(compiled.relevance_, python.relevance_)
+    np.testing.assert_allclose(compiled.predict(X), python.predict(X),
+                               rtol=1e-6, atol=1e-8)
+
+
+def test_compiled_fit_resumes_in_python(monkeypatch):
+    # Without noise the Hessian stops being positive definite after a few
+    # iterations, the Python loop has to carry on from there instead of
+    # starting over
+    pytest.importorskip("numba")
+    import scipy.linalg
+
+    X, y = _sinc_data(noise=0)
+
+    cho_factor = scipy.linalg.cho_factor
+    factored = []
+
+    def recording_cho_factor(a, *args, **kwargs):
+        factored.append(a.shape[0])
+        return cho_factor(a, *args, **kwargs)
+
+    results = _record_fit_loop(monkeypatch)
+    monkeypatch.setattr(scipy.linalg, "cho_factor", recording_cho_factor)
+    clf = EMRVR(gamma=1.0)
+    with pytest.warns(UserWarning, match="not positive definite"):
+        clf.fit(X, y)
+
+    (result,) = results
+    success, n_iter, active = result[:3]
+    assert not success and n_iter > 0
+    # The first Hessian of the Python loop is the one the compiled loop
+    # failed on, not the full one of the first iteration
+    assert factored[0] == active.shape[0] < X.shape[0] + 1
+    np.testing.assert_allclose(clf.predict(X), y, atol=1e-3)
+
+
+def test_compiled_fit_zero_residual(monkeypatch):
+    # A zero target gives a zero residual in the first beta update, the
+    # division by it has to give inf on both paths instead of raising. The
+    # initial beta is 1 / epsilon ** 2 here, a larger epsilon keeps the
+    # first Hessian factorable so that the compiled loop gets that far
+    pytest.importorskip("numba")
+    from sklearn_rvm import _fit_numba
+
+    X = np.linspace(-5, 5, 40).reshape(-1, 1)
+    y = np.zeros(40)
+
+    results = _record_fit_loop(monkeypatch)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        compiled = EMRVR(gamma=0.5, bias_used=False, epsilon=1e-3)
+        compiled.fit(X, y)
+        assert [result[0] for result in results] == [True]
+
+        monkeypatch.setattr(_fit_numba, "fit_loop", None)
+        python = EMRVR(gamma=0.5, bias_used=False, epsilon=1e-3)
+        python.fit(X, y)
+
+    np.testing.assert_array_equal(compiled.relevance_, python.relevance_)
+    np.testing.assert_array_equal(compiled.mu_, python.mu_)
+    np.testing.assert_array_equal(compiled.beta_, python.beta_)
+
+
+def test_compiled_loop_compiles_without_warnings():
+    numba = pytest.importorskip("numba")
+    from sklearn_rvm import _fit_numba
+
+    # Compile a fresh copy so that an on-disk cache cannot hide warnings
+    fit_loop = numba.njit(_fit_numba._fit_loop)
+    X, y = _sinc_data(noise=0, n_samples=20)
+    Phi = np.exp(-(X - X.T) ** 2)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        fit_loop(Phi, y, Phi.T @ Phi, Phi.T @ y, np.full(20, 1e-2), 100.0,
+                 True, 10, 1e-3, 1e9, 1e-8)
+
+
+def test_predict_on_training_data():
+    X, y = _sinc_data()
+    clf = EMRVR(gamma=1.0)
+    clf.fit(X, y)
+
+    mean, std = clf.predict(X, return_std=True)
+    mean_train, std_train = clf.predict(X, return_std=True, X_is_train=True)
+    np.testing.assert_allclose(mean_train, mean)
+    np.testing.assert_allclose(std_train, std)
+
+    with pytest.raises(ValueError):
+        clf.predict(X[:10], X_is_train=True)
+    with pytest.raises(ValueError):
+        clf.predict(X[::-1], X_is_train=True)
+
+
+def _assert_beta_matches_direct_residual(clf, y):
+    # beta_ is re-estimated from the residual of the last mu_, recompute it
+    # from ||y - Phi_ @ mu_||^2. The tolerance covers the basis functions
+    # pruned after that update
+    ed = np.sum((y - clf.Phi_ @ clf.mu_) ** 2)
+    beta = max(y.shape[0] - np.sum(clf.gamma_), clf.epsilon) / ed
+    np.testing.assert_allclose(clf.beta_, beta, rtol=1e-2)
+
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_low_noise_residual(monkeypatch, compiled):
+    from sklearn_rvm import _fit_numba
+    if compiled:
+        pytest.importorskip("numba")
+    else:
+        monkeypatch.setattr(_fit_numba, "fit_loop", None)
+
+    X, y = _sinc_data(noise=1e-6)
+    clf = EMRVR(gamma=1.0)
+    clf.fit(X, y)
+
+    _assert_beta_matches_direct_residual(clf, y)
+
+
+def test_compute_marginal_likelihood():
+    X, y = _sinc_data()
+    clf = EMRVR(gamma=1.0, compute_score=True)
+    clf.fit(X, y)
+    assert np.all(np.isfinite(clf.scores_))
+
+    # upper_inv is the inverse of the upper Cholesky factor of the Hessian
+    hessian = (clf.beta_ * clf.Phi_.T @ clf.Phi_) + np.diag(clf.alpha_)
+    upper_inv = np.linalg.inv(np.linalg.cholesky(hessian).T)
+    ed = np.sum((y - clf.Phi_ @ clf.mu_) ** 2)
+    logdetH = np.linalg.slogdet(hessian)[1]
+    expected = ((100 * np.log(clf.beta_) - clf.beta_ * ed) / 2 - 0.5 * (
+        logdetH - np.sum(np.log(clf.alpha_)) + clf.mu_ ** 2 @ clf.alpha_))
+    ll = clf.compute_marginal_likelihood(upper_inv, ed, 100, y)
+    np.testing.assert_allclose(ll, expected)